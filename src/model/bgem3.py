@@ -1,3 +1,7 @@
+import os
+import copy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional, Union, List
 
 from ..utils.arguments import ModelArguments
@@ -6,15 +10,59 @@ from ..utils.info_nce import InfoNCE
 import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
+from torch.nn.attention import sdpa_kernel, SDPBackend
 from transformers import AutoModel, AutoTokenizer, XLMRobertaModel, XLMRobertaTokenizer
 
+# 缓存分配器在第一次cuda分配时才读取该配置; 用可扩展segment减少碎片, 代替每次请求的empty_cache
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+
+@torch.jit.script
+def _scaled_mm(q_reps: Tensor, p_reps: Tensor, inv_temperature: float) -> Tensor:
+    # 用预先计算的1/temperature做乘法代替除法; matmul和缩放仍是两个kernel, script只省去python调度开销
+    # 只script这个叶子函数, 不script包含HF模型的module
+    # 缩放在fp32下进行, 避免1/temperature放大低精度logits的舍入误差
+    return torch.matmul(q_reps, p_reps.transpose(-2, -1)).float() * inv_temperature
+
+
+@torch.compile(dynamic=True)
+def _cls_norm(cls: Tensor) -> Tensor:
+    # L2 normalize融合为一个kernel; 输入为(N, D), N动态, 避免每个新的batch大小都重新编译
+    return cls * torch.rsqrt((cls * cls).sum(-1, keepdim=True).clamp_min(1e-12))
+
+
+class _CLSOnlyLayerMixin:
+    """
+    推理时最后一层只为CLS计算query和FFN, key/value仍使用全部token, 输出的last_hidden_state长度为1
+    """
+    def forward(self, hidden_states, attention_mask=None, *args, **kwargs):
+        if self.training:
+            return super().forward(hidden_states, attention_mask, *args, **kwargs)
+
+        self_attn = self.attention.self
+        batch_size, seq_len, _ = hidden_states.shape
+        num_heads, head_size = self_attn.num_attention_heads, self_attn.attention_head_size
+
+        cls = hidden_states[:, :1]
+        query = self_attn.query(cls).view(batch_size, 1, num_heads, head_size).transpose(1, 2)
+        key = self_attn.key(hidden_states).view(batch_size, seq_len, num_heads, head_size).transpose(1, 2)
+        value = self_attn.value(hidden_states).view(batch_size, seq_len, num_heads, head_size).transpose(1, 2)
+        if attention_mask is not None:
+            # (B, 1, 1|L, L) -> (B, 1, 1, L)
+            attention_mask = attention_mask[..., :1, :]
+        context = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        context = context.transpose(1, 2).reshape(batch_size, 1, num_heads * head_size)
+
+        attention_output = self.attention.output(context, cls)
+        layer_output = self.output(self.intermediate(attention_output), attention_output)
+        return (layer_output,)
+
 
 class M3DenseEmbedModel(nn.Module):
 
     def __init__(self, model_args: ModelArguments):
         super().__init__()
         self.load_model(model_args)
-        self.cross_entropy = nn.CrossEntropyLoss(reduction='mean')
         self.info_nce = InfoNCE(negative_mode="paired")
 
         self.normlized = model_args.normlized
@@ -23,6 +71,10 @@ class M3DenseEmbedModel(nn.Module):
 
         if not model_args.normlized:
             self.temperature = 1.0
+        self.inv_temperature = 1.0 / self.temperature
+
+        # is_bf16_supported()在新版本torch中把模拟bf16也算作支持, 这里只在Ampere及以上启用bf16 autocast
+        self.use_bf16 = torch.cuda.is_available() and torch.cuda.get_device_capability() >= (8, 0)
 
     def gradient_checkpointing_enable(self, **kwargs):
         self.model.enable_input_require_grads()
@@ -39,19 +91,30 @@ class M3DenseEmbedModel(nn.Module):
                 bnb_4bit_compute_dtype=torch.bfloat16,
                 bnb_4bit_quant_type="nf4",
                 bnb_4bit_use_double_quant=True,
+                attn_implementation="sdpa",
             )
         else:
-            torch_dtype = torch.float32
-            if model_load_args.model_with_fp16:
-                torch_dtype = torch.half
+            if model_load_args.shard_model:
+                device_map = "auto"
+            elif torch.cuda.is_available():
+                device_map = {"": int(os.environ.get("LOCAL_RANK", 0))}
+            else:
+                device_map = None
             self.model: XLMRobertaModel = AutoModel.from_pretrained(
                 model_load_args.model_path,
                 low_cpu_mem_usage=True,
-                device_map="auto",
-                torch_dtype=torch_dtype,
+                device_map=device_map,
+                torch_dtype=torch.float32,
                 add_pooling_layer=False,
+                attn_implementation="sdpa",
             )
 
+        # 替换类而不是包一层module, 保持state_dict的key不变
+        last_layer = self.model.encoder.layer[-1]
+        last_layer.__class__ = type(
+            f"CLSOnly{type(last_layer).__name__}", (_CLSOnlyLayerMixin, type(last_layer)), {}
+        )
+
         self.tokenizer:XLMRobertaTokenizer = AutoTokenizer.from_pretrained(model_load_args.tokenizer_path)
 
         if model_load_args.train_with_lora:
@@ -65,39 +128,201 @@ class M3DenseEmbedModel(nn.Module):
                         if param.grad is not None and param.grad.data is not None:
                             param.grad.data = param.grad.data.half()
 
-    def _encode(self, features) -> Tensor:
+    def _encode(self, features, model: Optional[nn.Module] = None) -> Tensor:
         dense_vecs = None
-        last_hidden_state = self.model(**features, return_dict=True).last_hidden_state
+        # sdpa_kernel修改的是进程全局的状态, 多线程下交错退出会互相覆盖;
+        # 传入model(模型副本)时由_encode_replicas在线程池外统一设置
+        if features['attention_mask'].is_cuda and model is None:
+            # 只使用flash/memory efficient kernel, 不实例化(B, H, L, L)的attention矩阵
+            with sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]):
+                last_hidden_state = self.model(**features, return_dict=True).last_hidden_state
+        else:
+            model = self.model if model is None else model
+            last_hidden_state = model(**features, return_dict=True).last_hidden_state
+        # 推理时last_hidden_state只包含CLS (见_CLSOnlyLayerMixin)
         dense_vecs = last_hidden_state[:, 0]
         if self.normlized:
+            if dense_vecs.is_cuda:
+                return _cls_norm(dense_vecs)
             dense_vecs = F.normalize(dense_vecs, dim=-1)
         return dense_vecs
 
-    def encode(self, features: Dict[str, Tensor]=None) -> Tensor:
+    def encode(self, features: Dict[str, Tensor]=None, sub_batch_size: Optional[int] = None) -> Tensor:
         if features is None:
             return None
 
-        if self.sub_batch_size is not None and self.sub_batch_size != -1:
-            all_dense_vecs = []
-            for i in range(0, len(features['attention_mask']), self.sub_batch_size):
-                end_inx = min(i + self.sub_batch_size, len(features['attention_mask']))
+        if sub_batch_size is None:
+            sub_batch_size = self.sub_batch_size
+        if sub_batch_size is not None and sub_batch_size != -1:
+            # 第一个sub batch编码后按其dtype预分配输出, 之后原地写入, 避免torch.cat的额外拷贝
+            dense_vecs = None
+            for i in range(0, len(features['attention_mask']), sub_batch_size):
+                end_inx = min(i + sub_batch_size, len(features['attention_mask']))
                 sub_features = {}
                 for k, v in features.items():
                     sub_features[k] = v[i:end_inx]
-                all_dense_vecs.append(self._encode(sub_features))
-            dense_vecs = torch.cat(all_dense_vecs, 0)
+                sub_dense_vecs = self._encode(sub_features)
+                if dense_vecs is None:
+                    dense_vecs = sub_dense_vecs.new_empty((len(features['attention_mask']), sub_dense_vecs.size(-1)))
+                dense_vecs[i:end_inx] = sub_dense_vecs
         else:
             dense_vecs = self._encode(features)
 
-        return dense_vecs.contiguous()
+        return dense_vecs
+
+    def _merge_group(self, xs: List[Dict[str, Tensor]]) -> Dict[str, Tensor]:
+        '''
+        将group内G个(batch_size, seq_len_g)的输入右侧padding到同一长度后拼接为(group_size*batch_size, max_len)
+        '''
+        max_len = max(x['attention_mask'].size(-1) for x in xs)
+        merged = {}
+        for k in xs[0].keys():
+            pad_value = self.tokenizer.pad_token_id if k == 'input_ids' else 0
+            merged[k] = torch.cat([F.pad(x[k], (0, max_len - x[k].size(-1)), value=pad_value) for x in xs], dim=0)
+        return merged
+
+    def encode_group(self, xs: List[Dict[str, Tensor]]) -> Tensor:
+        '''
+        sub_batch_size按每个样本计, 合并后的batch每次编码sub_batch_size*group_size行
+        否则sub_batch_size=1时会拆回G次前向, 还多了padding
+        '''
+        group_size = len(xs)
+        sub_batch_size = self.sub_batch_size
+        if sub_batch_size is not None and sub_batch_size != -1:
+            sub_batch_size *= group_size
+        dense_vecs = self.encode(self._merge_group(xs), sub_batch_size)
+        # (group_size*batch_size, embed_size) -> (batch_size, group_size, embed_size)
+        return dense_vecs.view(group_size, -1, dense_vecs.size(-1)).transpose(0, 1)
+
+    def _place_for_inference(self, device: str, use_fp16: bool):
+        '''
+        推理时的设备放置; 多卡时每张卡放一份完整的模型副本, 由encode_sorted按batch分发
+        '''
+        if torch.cuda.is_available() and device == "cuda":
+            self.device = torch.device("cuda")
+        else:
+            self.device = torch.device("cpu")
+            use_fp16 = False
+        if use_fp16: self.model.half()
+        self.model = self.model.to(self.device)
+        self.num_gpus = torch.cuda.device_count() if self.device.type == "cuda" else 0
+        self.replicas = [self.model]
+        self._emb_host = None
+        for i in range(1, self.num_gpus):
+            self.replicas.append(copy.deepcopy(self.model).to(torch.device("cuda", i)))
+
+    def _pad_batch(self, tokenized, idxs: List[int]):
+        return self.tokenizer.pad(
+            {k: [tokenized[k][j] for j in idxs] for k in ('input_ids', 'attention_mask')},
+            padding=True,
+            return_tensors="pt",
+        )
+
+    def _prefetch(self, tokenized, idxs: List[int], copy_stream=None):
+        '''
+        padding一个batch并发起H2D拷贝; cuda上使用pinned memory在copy_stream上异步拷贝, 返回(batch, event)
+        '''
+        batch = self._pad_batch(tokenized, idxs)
+        if copy_stream is None:
+            return batch.to(self.device), None
+        with torch.cuda.stream(copy_stream):
+            batch = {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in batch.items()}
+        return batch, copy_stream.record_event()
+
+    def _host_buffer(self, num: int, like: Tensor) -> Tensor:
+        '''
+        复用的pinned memory缓冲区, 不够大时重新分配
+        '''
+        if (self._emb_host is None or self._emb_host.size(0) < num
+                or self._emb_host.size(1) != like.size(-1) or self._emb_host.dtype != like.dtype):
+            self._emb_host = torch.empty((num, like.size(-1)), dtype=like.dtype, pin_memory=True)
+        return self._emb_host[:num]
+
+    def encode_sorted(self, sentences: List[str], batch_size: int, max_length: int, to_host: bool = False) -> Tensor:
+        '''
+        按token长度排序后分batch编码, 每个batch只padding到batch内最长, 最后按原顺序还原
+        下一个batch的padding和H2D拷贝与当前batch的编码重叠; 多卡时batch轮流分发给各卡的模型副本
+        to_host时返回cpu上的tensor, 每个batch的D2H拷贝与下一个batch的编码重叠
+        需要子类先调用_place_for_inference
+        '''
+        tokenized = self.tokenizer(sentences, truncation=True, max_length=max_length, return_length=True)
+        order = torch.tensor(tokenized['length']).argsort()
+        if len(self.replicas) > 1:
+            dense_vecs = self._encode_replicas(tokenized, order, batch_size)
+            return dense_vecs.cpu() if to_host else dense_vecs
+
+        copy_stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+        d2h_stream = torch.cuda.Stream() if to_host and self.device.type == "cuda" else None
+        host_dense_vecs = None
+
+        # 每个batch直接写回原顺序的位置, 不需要torch.cat和最后的反排列
+        dense_vecs = None
+        next_batch = self._prefetch(tokenized, order[:batch_size].tolist(), copy_stream)
+        for i in range(0, len(sentences), batch_size):
+            batch, ready = next_batch
+            if i + batch_size < len(sentences):
+                next_batch = self._prefetch(tokenized, order[i + batch_size:i + 2 * batch_size].tolist(), copy_stream)
+            if ready is not None:
+                torch.cuda.current_stream().wait_event(ready)
+                for v in batch.values():
+                    v.record_stream(torch.cuda.current_stream())
+            batch_dense_vecs = self._encode(batch)
+            if d2h_stream is not None:
+                # 按排序后的顺序连续写入pinned buffer, 最后在cpu上还原顺序
+                if host_dense_vecs is None:
+                    host_dense_vecs = self._host_buffer(len(sentences), batch_dense_vecs)
+                d2h_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(d2h_stream):
+                    host_dense_vecs[i:i + batch_size].copy_(batch_dense_vecs, non_blocking=True)
+                batch_dense_vecs.record_stream(d2h_stream)
+                continue
+            if dense_vecs is None:
+                dense_vecs = batch_dense_vecs.new_empty((len(sentences), batch_dense_vecs.size(-1)))
+            dense_vecs[order[i:i + batch_size].to(dense_vecs.device)] = batch_dense_vecs
+
+        if d2h_stream is not None:
+            d2h_stream.synchronize()
+            return host_dense_vecs[order.argsort()]
+        return dense_vecs.cpu() if to_host else dense_vecs
+
+    def _encode_on_replica(self, replica_idx: int, tokenized, batches: List[Tensor], grad_enabled: bool):
+        model = self.replicas[replica_idx]
+        device = torch.device("cuda", replica_idx)
+        results = []
+        # grad mode是线程局部的, 需要沿用调用线程的设置
+        with torch.cuda.device(device), torch.cuda.stream(torch.cuda.Stream(device)), torch.set_grad_enabled(grad_enabled):
+            for idxs in batches:
+                batch = self._pad_batch(tokenized, idxs.tolist())
+                batch = {k: v.pin_memory().to(device, non_blocking=True) for k, v in batch.items()}
+                results.append((idxs, self._encode(batch, model)))
+            torch.cuda.current_stream().synchronize()
+        return results
+
+    def _encode_replicas(self, tokenized, order: Tensor, batch_size: int) -> Tensor:
+        batches = list(order.split(batch_size))
+        num_replicas = len(self.replicas)
+        with sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]), \
+                ThreadPoolExecutor(num_replicas) as executor:
+            futures = [
+                executor.submit(self._encode_on_replica, i, tokenized, batches[i::num_replicas], torch.is_grad_enabled())
+                for i in range(num_replicas)
+            ]
+            results = [result for future in futures for result in future.result()]
 
-    def compute_similarity(self, q_reps:Tensor, p_reps:Tensor) -> Tensor:
-        return torch.matmul(q_reps, p_reps.transpose(-2, -1))
+        dense_vecs = None
+        for idxs, batch_dense_vecs in results:
+            if dense_vecs is None:
+                dense_vecs = batch_dense_vecs.new_empty((len(order), batch_dense_vecs.size(-1)), device=self.device)
+            dense_vecs[idxs.to(self.device)] = batch_dense_vecs.to(self.device)
+        return dense_vecs
 
     def dense_score(self, q_reps, p_reps):
-        scores = self.compute_similarity(q_reps, p_reps) / self.temperature
-        scores = scores.view(q_reps.size(0), -1)
-        return scores
+        if self.normlized and q_reps.is_cuda:
+            # 归一化后的向量用fp16计算相似度精度足够, loss部分仍用fp32
+            q_reps, p_reps = q_reps.half(), p_reps.half()
+        # 关闭autocast, 否则训练时fp16输入会被再次转为bf16
+        with torch.autocast(device_type="cuda", enabled=False):
+            return _scaled_mm(q_reps, p_reps, self.inv_temperature).view(q_reps.size(0), -1)
 
     def entity_embed_loss(self, head:Tensor, head_desc:Tensor, tail:Tensor, tail_desc:Tensor) -> Tensor:
         q_dense_vecs = torch.cat([head[:, 0, :], tail[:, 0, :]], dim=0)
@@ -106,37 +331,52 @@ class M3DenseEmbedModel(nn.Module):
         idxs = torch.arange(q_dense_vecs.size(0), device=q_dense_vecs.device, dtype=torch.long)
         targets = idxs * (p_dense_vecs.size(0) // q_dense_vecs.size(0))
         dense_scores = self.dense_score(q_dense_vecs, p_dense_vecs)  # B, B * N
-        loss = self.cross_entropy(dense_scores, targets)
+        # 等价于mean reduction的cross entropy, 不实例化softmax
+        lse = torch.logsumexp(dense_scores, dim=-1)
+        pos = dense_scores.gather(1, targets.unsqueeze(1)).squeeze(1)
+        loss = (lse - pos).mean()
 
         return loss
 
-    def kg_embed_loss(self, head, link_desc, tail) -> List[Tensor]:
+    def kg_embed_loss(self, head, link_desc, tail) -> Tensor:
+        '''
+        两个方向(head+link -> tail, tail-link -> head)拼成一个batch, 只调用一次info_nce
+        返回值为两个方向loss的均值
+        '''
         head_pos = head[:, 0, :]
-        head_neg = head[:, 1:, :]
         tail_pos = tail[:, 0, :]
-        tail_neg = tail[:, 1:, :]
 
-        return (self.info_nce(head_pos + link_desc, tail_pos, tail_neg),
-                self.info_nce(tail_pos - link_desc, head_pos, head_neg))
+        query = torch.cat([head_pos + link_desc, tail_pos - link_desc], dim=0)
+        positive_key = torch.cat([tail_pos, head_pos], dim=0)
+        negative_keys = torch.cat([tail[:, 1:, :], head[:, 1:, :]], dim=0)
+
+        return self.info_nce(query, positive_key, negative_keys)
 
     def forward(self, inputs):
         # torch.cuda.empty_cache()
         head, head_desc, link_desc, tail, tail_desc = inputs
 
-        # (batch_size, group_size, embed_size)
-        f = lambda x: torch.stack(list(map(self.encode, x)), dim=1)
-        head, head_desc, tail, tail_desc = map(f, (head, head_desc, tail, tail_desc))
-        # (batch_size, embed_size)
-        link_desc = self.encode(link_desc)
+        # 权重保持fp32, 支持bf16的gpu上前向在bf16 autocast下计算
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=self.use_bf16):
+            # (batch_size, group_size, embed_size)
+            head, head_desc, tail, tail_desc = map(self.encode_group, (head, head_desc, tail, tail_desc))
+            # (batch_size, embed_size)
+            link_desc = self.encode(link_desc)
 
-        loss1 = self.entity_embed_loss(head, head_desc, tail, tail_desc)
-        loss2, loss3 = self.kg_embed_loss(head, link_desc, tail)
+            loss1 = self.entity_embed_loss(head, head_desc, tail, tail_desc)
+            loss2 = self.kg_embed_loss(head, link_desc, tail)
 
-        return (loss1 + loss2 + loss3) / 3
+        # loss2为两个方向的均值, 与原先(loss1 + loss2 + loss3) / 3等价
+        return (loss1 + 2 * loss2) / 3
 
     def save(self, output_dir: str) -> None:
-        _trans_state_dict = lambda state_dict: type(state_dict)({k: v.clone().cpu() for k,v in state_dict.items()})
-        self.model.save_pretrained(output_dir, state_dict=_trans_state_dict(self.model.state_dict()))
+        # .to("cpu")本身就会产生新tensor, 无需clone; 异步拷贝, 最后对每张卡同步一次
+        state_dict = self.model.state_dict()
+        devices = {v.device for v in state_dict.values() if v.is_cuda}
+        state_dict = type(state_dict)({k: v.detach().to("cpu", non_blocking=True) for k, v in state_dict.items()})
+        for device in devices:
+            torch.cuda.synchronize(device)
+        self.model.save_pretrained(output_dir, state_dict=state_dict, safe_serialization=True)
 
 
 class M3ForInference(M3DenseEmbedModel):
@@ -147,37 +387,27 @@ class M3ForInference(M3DenseEmbedModel):
         device: str = "cpu"
     ):
         super().__init__(model_load_args)
-        if torch.cuda.is_available() and device == "cuda":
-            self.device = torch.device("cuda")
-        else:
-            self.device = torch.device("cpu")
-            use_fp16 = False
-        if use_fp16: self.model.half()
-        self.model = self.model.to(self.device)
-        self.num_gpus = torch.cuda.device_count()
-        if self.num_gpus > 1:
-            self.model = torch.nn.DataParallel(self.model)
+        self._place_for_inference(device, use_fp16)
 
+    @torch.no_grad()
     def __call__(
         self,
         sentences: Union[List[str], str],
         max_length: int = 8192,
+        to_host: bool = False,
     ) -> Tensor:
-        self.model.eval()
+        for model in self.replicas:
+            model.eval()
 
         input_was_string = False
         if isinstance(sentences, str):
             sentences = [sentences]
             input_was_string = True
 
-        inputs = self.tokenizer(
-            sentences,
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-            max_length=max_length,
-        ).to(self.device)
-        all_embeddings = self.encode(inputs)
+        batch_size = len(sentences)
+        if self.sub_batch_size is not None and self.sub_batch_size != -1:
+            batch_size = self.sub_batch_size
+        all_embeddings = self.encode_sorted(sentences, batch_size, max_length, to_host)
 
         if input_was_string:
             return all_embeddings[0]
@@ -193,58 +423,72 @@ class M3ForScore(M3DenseEmbedModel):
         temperature: float = 1.0,
         use_fp16: bool = True,
         device: str = "cpu",
-        batch_size: int = 512
+        batch_size: int = 512,
+        use_int8: bool = False,
+        doc_cache_size: int = 10000,
     ):
-        super().__init__(
-            model_load_args=model_load_args,
-            normlized=normlized,
-            sentence_pooling_method=sentence_pooling_method,
-            temperature=temperature,
-            enable_sub_batch=False,
-        )
-        if torch.cuda.is_available() and device == "cuda":
-            self.device = torch.device("cuda")
-        else:
-            self.device = torch.device("cpu")
-            use_fp16 = False
-        if use_fp16: self.model.half()
-        self.model = self.model.to(self.device)
+        super().__init__(model_load_args)
+        # 只支持cls pooling, 按batch_size分batch编码, 不再使用sub batch
+        self.normlized = normlized
+        self.temperature = temperature if normlized else 1.0
+        self.inv_temperature = 1.0 / self.temperature
+        self.sub_batch_size = None
         self.model.eval()
-        self.num_gpus = torch.cuda.device_count()
-        if self.num_gpus > 1:
-            self.model = torch.nn.DataParallel(self.model)
+        self._place_for_inference(device, use_fp16)
+        if use_int8:
+            for model in self.replicas:
+                self._quantize_int8(model)
         self.batch_size = batch_size
         self.max_length = 8192
+        # 文档文本 -> dense向量的LRU缓存, 同一语料多次查询时不再重复编码
+        self.doc_cache_size = doc_cache_size
+        self._doc_cache: OrderedDict[str, Tensor] = OrderedDict()
+
+    def _quantize_int8(self, model: nn.Module):
+        '''
+        只量化encoder中的nn.Linear, embedding和LayerNorm保持原精度
+        cuda上使用torchao的int8 weight only量化, cpu上使用pytorch自带的动态量化
+        '''
+        layers = model.encoder.layer
+        if self.device.type == "cuda":
+            from torchao.quantization import quantize_, int8_weight_only
+            quantize_(layers, int8_weight_only(), filter_fn=lambda module, fqn: isinstance(module, nn.Linear))
+        else:
+            torch.ao.quantization.quantize_dynamic(layers, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    def encode_documents(self, documents: List[str]) -> Tensor:
+        if self.doc_cache_size <= 0:
+            return self.encode_sorted(documents, self.batch_size, self.max_length)
+
+        new_documents = list(dict.fromkeys(doc for doc in documents if doc not in self._doc_cache))
+        if len(new_documents) > 0:
+            dense_vecs = self.encode_sorted(new_documents, self.batch_size, self.max_length)
+            # 每行单独clone, 否则缓存中的任一行都会让整个batch的显存无法释放
+            self._doc_cache.update(zip(new_documents, [v.clone() for v in dense_vecs]))
+        for doc in documents:
+            self._doc_cache.move_to_end(doc)
+        dense_vecs = torch.stack([self._doc_cache[doc] for doc in documents])
+
+        while len(self._doc_cache) > self.doc_cache_size:
+            self._doc_cache.popitem(last=False)
+        return dense_vecs
 
+    @torch.no_grad()
     def select_topk(self, query: str, documents: List[str], k=1) -> torch.Tensor:
         """
         Returns:
-            `ret`: `torch.return_types.topk`, use `ret.values` or `ret.indices` to get value or index tensor
+            `indices`: 1-D `torch.LongTensor` of the top `min(k, len(documents))` document indices, best first
         """
-        query = self.tokenizer(
-            [query],
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-            max_length=self.max_length,
-        ).to(self.device)
-        documents = self.tokenizer(
-            documents,
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-            max_length=self.max_length,
-        ).to(self.device)
-
-        query = self.encode(query)
-        documents = self.encode(documents, self.batch_size)
+        query = self.encode_sorted([query], 1, self.max_length)
+        documents = self.encode_documents(documents)
 
-        scores = self.dense_score(query, documents).squeeze_()
+        scores = self.dense_score(query, documents)[0]
+        if k == 1:
+            return scores.argmax(-1, keepdim=True)
         return scores.topk(min(k, len(scores))).indices
 
     def __call__(self, query, paragraphs: List[Dict[str, str]], topk=5) -> List[Dict[str, str]]:
-        torch.cuda.empty_cache()
         texts = [item['text'] for item in paragraphs]
         topk = self.select_topk(query, texts, topk)
-        indices = topk.detach().cpu().numpy().tolist()
-        return [paragraphs[int(idx)] for idx in indices]
+        # 只拷贝k个下标到cpu
+        return [paragraphs[idx] for idx in topk.tolist()]
@@ -22,7 +22,6 @@ class ModelArguments:
     normlized: bool = field(default=True, metadata={"help": ""})
     temperature: float = field(default=0.02, metadata={"help": ""})
     encode_sub_batch_size: int = field(default=1, metadata={"help": ""})
-    model_with_fp16: bool = field(default=False, metadata={"help": ""})
     lora_with_fp16: bool = field(default=False, metadata={"help": ""})
     train_with_lora: bool = field(default=False, metadata={"help": ""})
     lora_modules: Union[str, List[str]] = field(
@@ -30,6 +29,11 @@ class ModelArguments:
         metadata={"help": ""},
     )
     train_with_qlora: bool = field(default=False, metadata={"help": ""})
+    shard_model: bool = field(
+        default=False,
+        metadata={"help": "Load the backbone with device_map='auto' and shard it across visible GPUs, "
+                          "otherwise load it onto the local GPU"},
+    )
 
 
 @dataclass
@@ -70,8 +70,8 @@ def find_knn_neg(
         # TODO random choice
         queries:List[str] = [d["names"][0] for d in input_data.values()]
 
-    p_vecs = model(corpus).detach().cpu()
-    q_vecs = model(queries).detach().cpu()
+    p_vecs = model(corpus, to_host=True)
+    q_vecs = model(queries, to_host=True)
 
     index = create_index(p_vecs, use_gpu=use_gpu)
     _, all_inxs = batch_search(index, q_vecs, topk=sample_range[-1], batch_size=search_batch_size)